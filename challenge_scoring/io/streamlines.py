@@ -4,12 +4,15 @@
 import os
 
 import nibabel as nb
+from nibabel.streamlines import ArraySequence
 import numpy as np
 from numpy import linalg
 from numpy.lib.index_tricks import c_
 import tractconverter as tc
 from tractconverter.formats.tck import TCK
 
+from challenge_scoring.metrics.lengths import streamlines_lengths_mm
+
 
 def format_needs_orientation(tract_fname):
     tracts_format = tc.detect_format(tract_fname)
@@ -31,14 +34,11 @@ def guess_orientation(tract_fname):
     return 'Unknown'
 
 
-def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
-                           start_at_corner=True):
-    # TODO move to only get the attribute
+def _get_world_to_index_affine(tracts_file, ref_anat_fname,
+                               tract_attributes):
     # Tract_attributes is a dictionary containing various information
     # about a dataset. Currently using:
     # - "orientation" (should be LPS or RAS)
-    tracts_format = tc.detect_format(tract_fname)
-    tracts_file = tracts_format(tract_fname)
 
     # Get information on the supporting anatomy
     ref_img = nb.load(ref_anat_fname)
@@ -62,7 +62,39 @@ def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
 
     # Transposed for efficient computations later on.
     index_to_world_affine = index_to_world_affine.T.astype('<f4')
-    world_to_index_affine = linalg.inv(index_to_world_affine)
+
+    return linalg.inv(index_to_world_affine)
+
+
+def _read_trk_streamlines(tract_fname):
+    # Use nb.trackvis to read directly in correct space
+    # TODO this should be made more robust, using
+    # all fields in header.
+    # Currently, load in rasmm space, and then bring back to LPS vox
+    try:
+        streamlines, _ = nb.trackvis.read(tract_fname,
+                                          as_generator=True,
+                                          points_space='rasmm')
+    except nb.trackvis.HeaderError as er:
+        print(er)
+        raise ValueError("\n------ ERROR ------\n\n" +\
+              "TrackVis header is malformed or incomplete.\n" +\
+              "Please make sure all fields are correctly set.\n\n" +\
+              "The error message reported by Nibabel was:\n" +\
+              str(er))
+
+    return streamlines
+
+
+def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
+                           start_at_corner=True):
+    # TODO move to only get the attribute
+    tracts_format = tc.detect_format(tract_fname)
+    tracts_file = tracts_format(tract_fname)
+
+    world_to_index_affine = _get_world_to_index_affine(tracts_file,
+                                                       ref_anat_fname,
+                                                       tract_attributes)
 
     # Load tracts
     if isinstance(tracts_file, tc.formats.tck.TCK)\
@@ -77,21 +109,7 @@ def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
                                    world_to_index_affine)[:, :-1] + shift
             yield transformed_s
     elif isinstance(tracts_file, tc.formats.trk.TRK):
-         # Use nb.trackvis to read directly in correct space
-         # TODO this should be made more robust, using
-         # all fields in header.
-         # Currently, load in rasmm space, and then bring back to LPS vox
-        try:
-            streamlines, _ = nb.trackvis.read(tract_fname,
-                                              as_generator=True,
-                                              points_space='rasmm')
-        except nb.trackvis.HeaderError as er:
-            print(er)
-            raise ValueError("\n------ ERROR ------\n\n" +\
-                  "TrackVis header is malformed or incomplete.\n" +\
-                  "Please make sure all fields are correctly set.\n\n" +\
-                  "The error message reported by Nibabel was:\n" +\
-                  str(er))
+        streamlines = _read_trk_streamlines(tract_fname)
 
         if start_at_corner:
             shift = 0.0
@@ -114,6 +132,45 @@ def get_tracts_voxel_space_for_dipy(tract_fname, ref_anat_fname, tract_attribute
                                  False)
 
 
+def load_tracts_voxel_space_for_dipy(tract_fname, ref_anat_fname,
+                                     tract_attributes):
+    # Bulk version of get_tracts_voxel_space_for_dipy: streams the raw
+    # points directly into a single ArraySequence buffer, then applies the
+    # world-to-voxel transform once on the whole concatenated buffer (one
+    # matrix product over all points) instead of once per streamline.
+    tracts_format = tc.detect_format(tract_fname)
+    tracts_file = tracts_format(tract_fname)
+
+    world_to_index_affine = _get_world_to_index_affine(tracts_file,
+                                                       ref_anat_fname,
+                                                       tract_attributes)
+
+    if isinstance(tracts_file, tc.formats.tck.TCK)\
+        or isinstance(tracts_file, tc.formats.vtk.VTK):
+        shift = 0.0
+        tracts = ArraySequence(tracts_file)
+    elif isinstance(tracts_file, tc.formats.trk.TRK):
+        shift = 0.5
+        tracts = ArraySequence(s[0] for s in
+                               _read_trk_streamlines(tract_fname))
+    else:
+        raise ValueError('Unsupported tractogram format: '
+                         '{0}'.format(tract_fname))
+
+    points = tracts._data.astype('<f4', copy=False)
+
+    # Equivalent to dotting each homogeneous point with the transposed
+    # affine, as done in _get_tracts_over_grid.
+    tracts._data = np.dot(points, world_to_index_affine[:3, :3]) \
+        + world_to_index_affine[3, :3] + shift
+
+    # Memoize the per-streamline lengths on the sequence while the buffer
+    # is hot, so consumers share one vector instead of recomputing it.
+    tracts.lengths_mm = streamlines_lengths_mm(tracts)
+
+    return tracts
+
+
 def save_tracts_tck_from_dipy_voxel_space(tract_outobj, ref_anat_fname,
                                           tracts):
     # TODO validate that tract_outobj is a TCK file.
@@ -140,7 +197,7 @@ def save_valid_connections(extracted_vb_info, streamlines,
         return
 
     full_vcs = []
-    for bundle_name, bundle_info in extracted_vb_info.iteritems():
+    for bundle_name, bundle_info in extracted_vb_info.items():
         if bundle_info['nb_streamlines'] > 0:
             out_fname = os.path.join(segmented_out_dir, basename +
                                      '_VB_{0}.tck'.format(bundle_name))
@@ -176,7 +233,7 @@ def save_invalid_connections(ib_info, streamlines, ic_clusters,
 
     full_ic = []
 
-    for k, v in ib_info.iteritems():
+    for k, v in ib_info.items():
         out_strl = []
         for c_idx in v:
             out_strl.extend([s for s in np.array(streamlines)[
@@ -104,7 +104,12 @@ def group_and_assign_ibs(candidate_streamlines, ROIs,
     ic_counts = 0
     ib_pairs = {}
 
-    rejected_streamlines = []
+    # Indices (into candidate_streamlines, after the shuffle below) of the
+    # streamlines rejected as singletons. Preallocated at its upper bound
+    # and trimmed on return, so no list growth or final conversion is
+    # needed; callers can count and gather without re-boxing.
+    rejected_indices = np.empty(len(candidate_streamlines), dtype=np.int64)
+    nb_rejected = 0
 
     # Start by clustering all the remaining potentiel IC using QB.
 
@@ -125,8 +130,11 @@ def group_and_assign_ibs(candidate_streamlines, ROIs,
     # Is used in the get_closest_roi_pairs... function.
     rois_info = []
     for roi in ROIs:
+        # Read through dataobj instead of get_data() so the full volume is
+        # not cached on the image; it can be freed once the coordinates
+        # have been extracted, keeping only one ROI materialized at a time.
         rois_info.append((get_root_image_name(os.path.basename(roi.get_filename())),
-                          np.array(np.where(roi.get_data())).T))
+                          np.array(np.where(np.asanyarray(roi.dataobj))).T))
 
     all_ics_closest_pairs = get_closest_roi_pairs_for_all_streamlines(candidate_streamlines, rois_info)
 
@@ -152,7 +160,8 @@ def group_and_assign_ibs(candidate_streamlines, ROIs,
             else:
                 val.append(c_idx)
         else:
-            rejected_streamlines.append(candidate_streamlines[clusters[c]['indices'][0]])
+            rejected_indices[nb_rejected] = clusters[c]['indices'][0]
+            nb_rejected += 1
 
     if save_ibs or save_full_ic:
         save_invalid_connections(ib_pairs, candidate_streamlines,
@@ -162,4 +171,4 @@ def group_and_assign_ibs(candidate_streamlines, ROIs,
                                  save_full_ic=save_full_ic,
                                  save_ibs=save_ibs)
 
-    return rejected_streamlines, ic_counts, len(ib_pairs.keys())
+    return rejected_indices[:nb_rejected], ic_counts, len(ib_pairs.keys())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _lengths_numpy(data, offsets):
+    diffs = np.diff(data, axis=0)
+
+    # Accumulate in float64, like the numba kernel, so the computed
+    # lengths do not depend on which implementation is installed.
+    seg_lengths = np.sqrt(np.einsum('ij,ij->i', diffs, diffs,
+                                    dtype=np.float64))
+
+    if seg_lengths.size == 0:
+        # Single-point streamlines only; they all have zero length.
+        return np.zeros(len(offsets), dtype=np.float64)
+
+    # Zero out segments that would span two consecutive streamlines,
+    # so the reduceat below only sums intra-streamline segments.
+    if len(offsets) > 1:
+        seg_lengths[offsets[1:] - 1] = 0.
+
+    # A trailing single-point streamline has its offset one past the end
+    # of seg_lengths; clamp it onto the (zeroed) last crossing segment so
+    # reduceat yields 0.0 for it instead of raising.
+    offsets = np.minimum(offsets, seg_lengths.size - 1)
+
+    return np.add.reduceat(seg_lengths, offsets)
+
+
+if numba is not None:
+    # No fastmath: scores must not depend on whether numba is installed,
+    # so the kernel keeps strict IEEE semantics like the numpy path.
+    @numba.njit(parallel=True, cache=True)
+    def _lengths_numba(data, offsets, nb_points):  # pragma: no cover
+        nb_strl = offsets.shape[0]
+        strl_lengths = np.zeros(nb_strl, dtype=np.float64)
+
+        for i in numba.prange(nb_strl):
+            start = offsets[i]
+            end = start + nb_points[i]
+
+            total = 0.
+            for j in range(start, end - 1):
+                # Difference in the buffer dtype, then float64 for the
+                # squares and the accumulation, matching the numpy path.
+                dx = np.float64(data[j + 1, 0] - data[j, 0])
+                dy = np.float64(data[j + 1, 1] - data[j, 1])
+                dz = np.float64(data[j + 1, 2] - data[j, 2])
+                total += (dx * dx + dy * dy + dz * dz) ** 0.5
+
+            strl_lengths[i] = total
+
+        return strl_lengths
+
+
+def streamlines_lengths_mm(streamlines):
+    """
+    Compute the length of every streamline of an ArraySequence in a
+    single pass over the concatenated points buffer, instead of calling
+    dipy's length() once per streamline.
+
+    Uses a parallel numba kernel when numba is available, and a
+    vectorized numpy implementation otherwise.
+
+    Parameters
+    ------------
+    streamlines : ArraySequence
+        the streamlines, in a single contiguous buffer.
+
+    Returns
+    ---------
+    lengths : np.ndarray
+        the length of each streamline, in the space of the points.
+    """
+    if len(streamlines) == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    data = streamlines._data
+    offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+
+    if numba is not None:
+        nb_points = np.asarray(streamlines._lengths, dtype=np.intp)
+        return _lengths_numba(data, offsets, nb_points)
+
+    return _lengths_numpy(data, offsets)
@@ -3,64 +3,257 @@
 
 from __future__ import division
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import hashlib
 import logging
 import os
+import pickle
 
 import nibabel as nib
 import numpy as np
+from scipy.spatial import cKDTree
 
 from dipy.tracking.streamline import set_number_of_points
-from dipy.segment.clustering import QuickBundles
+from dipy.segment.clustering import ClusterCentroid, ClusterMapCentroid, \
+                                    QuickBundles
 from dipy.segment.metric import AveragePointwiseEuclideanMetric
-from dipy.tracking.metrics import length as slength
+from nibabel.streamlines import ArraySequence
+
+try:
+    from dipy.segment.clustering import QuickBundlesX
+except ImportError:
+    QuickBundlesX = None
 
 from tractconverter.formats.tck import TCK
 
 from challenge_scoring import NB_POINTS_RESAMPLE
-from challenge_scoring.io.streamlines import get_tracts_voxel_space_for_dipy, \
+from challenge_scoring.io.streamlines import load_tracts_voxel_space_for_dipy, \
                                        save_tracts_tck_from_dipy_voxel_space, \
                                        save_valid_connections
 from challenge_scoring.metrics.invalid_connections import group_and_assign_ibs
+from challenge_scoring.metrics.lengths import streamlines_lengths_mm
 from challenge_scoring.metrics.valid_connections import auto_extract_VCs
+from challenge_scoring.utils.filenames import mkdir
+
+
+# Bump whenever the layout of the pickled ref_bundles changes, so stale
+# caches are rebuilt instead of served with missing or outdated keys.
+GT_CACHE_SCHEMA_VERSION = 3
+
+
+def _gt_cache_fname(bundles_dir, gt_bundles_attribs, ref_anat_fname):
+    # Key the cache on the bundle file names and mtimes, the reference
+    # anatomy (its affine defines the cached voxel space), the resampling
+    # parameter, the bundle attributes and the cache schema version, so
+    # any change to the GT data invalidates the cached preparation.
+    hasher = hashlib.blake2b(digest_size=16)
+
+    hasher.update(repr(GT_CACHE_SCHEMA_VERSION).encode('utf-8'))
+
+    # scandir gives the mtimes without a second stat per file.
+    for entry in sorted(os.scandir(bundles_dir), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        hasher.update(entry.name.encode('utf-8'))
+        hasher.update(repr(entry.stat().st_mtime).encode('utf-8'))
+
+    hasher.update(os.path.abspath(ref_anat_fname).encode('utf-8'))
+    hasher.update(repr(os.path.getmtime(ref_anat_fname)).encode('utf-8'))
+
+    hasher.update(repr(NB_POINTS_RESAMPLE).encode('utf-8'))
+    hasher.update(repr(sorted(gt_bundles_attribs.items())).encode('utf-8'))
+
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME',
+                       os.path.join(os.path.expanduser('~'), '.cache')),
+        'tractometer')
+
+    return os.path.join(cache_dir, 'gt_{0}.pkl'.format(hasher.hexdigest()))
+
+
+def _load_gt_bundles_cache(cache_fname, bundles_masks_dir):
+    if not os.path.isfile(cache_fname):
+        return None
+
+    try:
+        with open(cache_fname, 'rb') as cache_file:
+            ref_bundles = pickle.load(cache_file)
+    except Exception:
+        logging.debug('Could not read GT bundles cache, rebuilding.')
+        return None
+
+    # Masks are stored as filename references; reload them here.
+    for ref_bundle in ref_bundles:
+        ref_bundle['mask'] = nib.load(os.path.join(
+            bundles_masks_dir, ref_bundle['name'] + '.nii.gz'))
+
+    return ref_bundles
+
+
+def _save_gt_bundles_cache(cache_fname, ref_bundles):
+    try:
+        mkdir(os.path.dirname(cache_fname))
+
+        # Nifti images do not pickle cleanly; masks are reloaded from their
+        # filenames on cache hits, so simply drop them here.
+        to_store = [{k: v for k, v in ref_bundle.items() if k != 'mask'}
+                    for ref_bundle in ref_bundles]
+
+        with open(cache_fname, 'wb') as cache_file:
+            pickle.dump(to_store, cache_file, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        logging.debug('Could not write GT bundles cache.')
 
 
 def _prepare_gt_bundles_info(bundles_dir, bundles_masks_dir,
                              gt_bundles_attribs, ref_anat_fname):
-    # Ref bundles will contain {'name': 'name_of_the_bundle',
-    #                           'threshold': thres_value,
-    #                           'streamlines': list_of_streamlines}
-
-    dummy_attribs = {'orientation': 'LPS'}
-    qb = QuickBundles(20, metric=AveragePointwiseEuclideanMetric())
+    # The prepared GT info is identical across submissions of a challenge,
+    # so it is cached on disk once built.
+    cache_fname = _gt_cache_fname(bundles_dir, gt_bundles_attribs,
+                                  ref_anat_fname)
 
-    ref_bundles = []
+    ref_bundles = _load_gt_bundles_cache(cache_fname, bundles_masks_dir)
+    if ref_bundles is not None:
+        logging.debug('Loaded GT bundles info from cache.')
+        return ref_bundles
 
-    for bundle_idx, bundle_f in enumerate(sorted(os.listdir(bundles_dir))):
-        bundle_name = os.path.splitext(os.path.basename(bundle_f))[0]
+    ref_bundles = _build_gt_bundles_info(bundles_dir, bundles_masks_dir,
+                                         gt_bundles_attribs, ref_anat_fname)
 
-        bundle_attribs = gt_bundles_attribs.get(os.path.basename(bundle_f))
-        if bundle_attribs is None:
-            raise ValueError(
-                "Missing basic bundle attribs for {0}".format(bundle_f))
+    _save_gt_bundles_cache(cache_fname, ref_bundles)
 
-        # Already resample to avoid doing it for each iteration of chunking
-        orig_strl = [s for s in get_tracts_voxel_space_for_dipy(
-                        os.path.join(bundles_dir, bundle_f),
-                        ref_anat_fname, dummy_attribs)]
+    return ref_bundles
 
-        resamp_bundle = set_number_of_points(orig_strl, NB_POINTS_RESAMPLE)
-        resamp_bundle = [s.astype('f4') for s in resamp_bundle]
 
+# Below this size, GT bundles are tight enough that clustering would
+# yield a single cluster anyway; short-circuit to the mean streamline.
+SMALL_GT_BUNDLE_SIZE = 50
+
+
+def _cluster_gt_bundle(resamp_bundle, resamp_arr):
+    # Cluster a resampled GT bundle to get representative centroids.
+    if len(resamp_bundle) <= SMALL_GT_BUNDLE_SIZE:
+        # Flip-align every streamline to the first one before averaging.
+        # MDF is flip-invariant but a plain mean is not: streamlines
+        # stored in mixed head/tail order would average to a degenerate
+        # midline centroid.
+        ref_strl = resamp_arr[0]
+        flipped_arr = resamp_arr[:, ::-1, :]
+        direct_dist = np.sqrt(
+            ((resamp_arr - ref_strl) ** 2).sum(axis=2)).mean(axis=1)
+        flipped_dist = np.sqrt(
+            ((flipped_arr - ref_strl) ** 2).sum(axis=2)).mean(axis=1)
+        aligned_arr = np.where((flipped_dist < direct_dist)[:, None, None],
+                               flipped_arr, resamp_arr)
+
+        cluster = ClusterCentroid(np.mean(aligned_arr, axis=0),
+                                  indices=list(range(len(resamp_bundle))))
+        bundle_cluster_map = ClusterMapCentroid(refdata=resamp_bundle)
+        bundle_cluster_map.add_cluster(cluster)
+        return bundle_cluster_map
+
+    if QuickBundlesX is not None:
+        # Hierarchical clustering is strictly faster than the flat version
+        # on large bundles; keep the finest (20mm) level's clusters.
+        qbx = QuickBundlesX([40, 20],
+                            metric=AveragePointwiseEuclideanMetric())
+        bundle_cluster_map = qbx.cluster(resamp_bundle).get_clusters(2)
+    else:
+        qb = QuickBundles(20, metric=AveragePointwiseEuclideanMetric())
         bundle_cluster_map = qb.cluster(resamp_bundle)
-        bundle_cluster_map.refdata = resamp_bundle
 
-        bundle_mask = nib.load(os.path.join(bundles_masks_dir,
-                                            bundle_name + '.nii.gz'))
+    bundle_cluster_map.refdata = resamp_bundle
+
+    return bundle_cluster_map
+
+
+def _prepare_one_bundle(bundle_f, bundles_dir, gt_bundles_attribs,
+                        ref_anat_fname):
+    # Prepare a single GT bundle. Must stay a module-level function so it
+    # can be dispatched to process pool workers.
+    # gt_bundles_attribs is expected to be keyed by basename already.
+    base_name = os.path.basename(bundle_f)
+    bundle_name = os.path.splitext(base_name)[0]
+    bundle_attribs = gt_bundles_attribs[base_name]
+
+    dummy_attribs = {'orientation': 'LPS'}
+
+    # Already resample to avoid doing it for each iteration of chunking.
+    # Loading as an ArraySequence lets set_number_of_points take its bulk
+    # contiguous path instead of dispatching per streamline.
+    orig_strl = load_tracts_voxel_space_for_dipy(
+        os.path.join(bundles_dir, bundle_f), ref_anat_fname, dummy_attribs)
+
+    resamp_bundle = set_number_of_points(orig_strl, NB_POINTS_RESAMPLE)
+    if not isinstance(resamp_bundle, ArraySequence):
+        # dipy < 0.13 returns a plain list here.
+        resamp_bundle = ArraySequence(resamp_bundle)
+
+    # Cast the single backing buffer instead of each streamline. All
+    # streamlines now have the same number of points, so the buffer also
+    # views as one contiguous stacked array.
+    resamp_bundle._data = resamp_bundle._data.astype('f4', copy=False)
+    resamp_arr = resamp_bundle._data.reshape(
+        (len(resamp_bundle), NB_POINTS_RESAMPLE, 3))
+    resamp_bundle = list(resamp_arr)
+
+    bundle_cluster_map = _cluster_gt_bundle(resamp_bundle, resamp_arr)
+
+    # kd-trees over the flattened centroids, in both orientations since
+    # the MDF distance is flip-invariant. They let auto_extract prefilter
+    # submission centroids instead of computing all-pairs MDF, and are
+    # persisted along with the rest through the GT cache.
+    centroids_arr = np.asarray(bundle_cluster_map.centroids, dtype='f4')
+    centroids_flat = centroids_arr.reshape((len(centroids_arr), -1))
+    flipped_flat = centroids_arr[:, ::-1, :].reshape((len(centroids_arr), -1))
+
+    return {'name': bundle_name,
+            'threshold': bundle_attribs['cluster_threshold'],
+            'cluster_map': bundle_cluster_map,
+            'centroid_tree': cKDTree(centroids_flat),
+            'centroid_tree_flipped': cKDTree(flipped_flat)}
+
+
+def _build_gt_bundles_info(bundles_dir, bundles_masks_dir,
+                           gt_bundles_attribs, ref_anat_fname):
+    # Ref bundles will contain {'name': 'name_of_the_bundle',
+    #                           'threshold': thres_value,
+    #                           'streamlines': list_of_streamlines}
+
+    bundle_files = sorted(e.name for e in os.scandir(bundles_dir)
+                          if e.is_file())
 
-        ref_bundles.append({'name': bundle_name,
-                            'threshold': bundle_attribs['cluster_threshold'],
-                            'cluster_map': bundle_cluster_map,
-                            'mask': bundle_mask})
+    # Normalize the attribs keys to basenames once, so neither the
+    # validation below nor the workers redo os.path work per lookup.
+    attribs_by_name = {os.path.basename(k): v
+                       for k, v in gt_bundles_attribs.items()}
+
+    # Validate upfront instead of failing in the middle of a worker.
+    for bundle_f in bundle_files:
+        if attribs_by_name.get(os.path.basename(bundle_f)) is None:
+            raise ValueError(
+                "Missing basic bundle attribs for {0}".format(bundle_f))
+
+    prepare = functools.partial(_prepare_one_bundle,
+                                bundles_dir=bundles_dir,
+                                gt_bundles_attribs=attribs_by_name,
+                                ref_anat_fname=ref_anat_fname)
+
+    # Bundles are independent of each other, so they can be prepared in
+    # parallel. executor.map preserves the input ordering.
+    if len(bundle_files) > 1:
+        max_workers = min(len(bundle_files), os.cpu_count())
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            ref_bundles = list(executor.map(prepare, bundle_files))
+    else:
+        ref_bundles = [prepare(bundle_f) for bundle_f in bundle_files]
+
+    # Masks are loaded in the parent process, since Nifti images do not
+    # cross process boundaries cleanly.
+    for ref_bundle in ref_bundles:
+        ref_bundle['mask'] = nib.load(os.path.join(
+            bundles_masks_dir, ref_bundle['name'] + '.nii.gz'))
 
     return ref_bundles
 
@@ -138,104 +331,169 @@ def score_submission(streamlines_fname,
     bundles_masks_dir = os.path.join(masks_dir, "bundles")
     ref_anat_fname = os.path.join(masks_dir, "wm.nii.gz")
 
+    # nib.load is lazy: only headers are read here. The ROI data itself is
+    # materialized one volume at a time when the IC assignment needs it.
     ROIs = [nib.load(os.path.join(rois_dir, f))
-            for f in sorted(os.listdir(rois_dir))]
+            for f in sorted(e.name for e in os.scandir(rois_dir)
+                            if e.is_file())]
 
     ref_bundles = _prepare_gt_bundles_info(bundles_dir,
                                            bundles_masks_dir,
                                            basic_bundles_attribs,
                                            ref_anat_fname)
 
-    streamlines_gen = get_tracts_voxel_space_for_dipy(streamlines_fname,
-                                                      ref_anat_fname,
-                                                      tracts_attribs)
-
-    # Load all streamlines, since streamlines is a generator.
-    full_strl = [s for s in streamlines_gen]
+    # Load all streamlines into a single ArraySequence buffer, with the
+    # voxel-space transform applied in one batched product over all points.
+    # The float32 buffer is also what qb.cluster expects; it had problem
+    # with f8.
+    full_strl = load_tracts_voxel_space_for_dipy(streamlines_fname,
+                                                 ref_anat_fname,
+                                                 tracts_attribs)
 
     # Extract VCs and VBs
     VC_indices, found_vbs_info = auto_extract_VCs(full_strl, ref_bundles)
     VC = len(VC_indices)
 
-    if save_VBs or save_full_vc:
-        save_valid_connections(found_vbs_info, full_strl, segmented_out_dir,
-                               segmented_base_name, ref_anat_fname,
-                               save_vbs=save_VBs, save_full_vc=save_full_vc)
-
-    logging.debug("Starting IC, IB scoring")
-
-    total_strl_count = len(full_strl)
-    candidate_ic_strl_indices = sorted(set(range(total_strl_count)) - VC_indices)
-
-    candidate_ic_streamlines = []
-    rejected_streamlines = []
-
-    # Chosen from GT dataset
-    length_thres = 35.
-
-    # Filter streamlines that are too short, consider them as NC
-    for idx in candidate_ic_strl_indices:
-        if slength(full_strl[idx]) >= length_thres:
-            candidate_ic_streamlines.append(full_strl[idx].astype('f4'))
-        else:
-            rejected_streamlines.append(full_strl[idx].astype('f4'))
-
-    logging.debug('Found {} candidate IC'.format(len(candidate_ic_streamlines)))
-    logging.debug('Found {} streamlines that were too short'.format(len(rejected_streamlines)))
-
-    ic_counts = 0
-    nb_ib = 0
-
-    if len(candidate_ic_streamlines):
-        additional_rejected, ic_counts, nb_ib = group_and_assign_ibs(
-                                                   candidate_ic_streamlines,
-                                                   ROIs, save_IBs, save_full_ic,
-                                                   segmented_out_dir,
-                                                   segmented_base_name,
-                                                   ref_anat_fname)
-
-        rejected_streamlines.extend(additional_rejected)
-
-    if ic_counts != len(candidate_ic_strl_indices) - len(rejected_streamlines):
-        raise ValueError("Some streamlines were not correctly assigned to NC")
-
-    if len(rejected_streamlines) > 0 and save_full_nc:
-        out_nc_fname = os.path.join(segmented_out_dir,
-                                    '{}_NC.tck'.format(segmented_base_name))
-        out_file = TCK.create(out_nc_fname)
-        save_tracts_tck_from_dipy_voxel_space(out_file, ref_anat_fname,
-                                              rejected_streamlines)
-
-    VC /= total_strl_count
-    IC = (len(candidate_ic_strl_indices) - len(rejected_streamlines)) / total_strl_count
-    NC = len(rejected_streamlines) / total_strl_count
-    VCWP = 0
-
-    nb_VB_found = [v['nb_streamlines'] > 0 for k, v in found_vbs_info.iteritems()].count(True)
-    streamlines_per_bundle = {k: v['nb_streamlines'] for k, v in found_vbs_info.iteritems() if v['nb_streamlines'] > 0}
-
-    scores = {}
-    scores['version'] = 2
-    scores['algo_version'] = 5
-    scores['VC'] = VC
-    scores['IC'] = IC
-    scores['VCWP'] = VCWP
-    scores['NC'] = NC
-    scores['VB'] = nb_VB_found
-    scores['IB'] = nb_ib
-    scores['streamlines_per_bundle'] = streamlines_per_bundle
-    scores['total_streamlines_count'] = total_strl_count
-
-    # Get bundle overlap, overreach and f1-score for each bundle.
-    scores['overlap_per_bundle'] = {k: v["overlap"] for k, v in found_vbs_info.items()}
-    scores['overreach_per_bundle'] = {k: v["overreach"] for k, v in found_vbs_info.items()}
-    scores['overreach_norm_gt_per_bundle'] = {k: v["overreach_norm"] for k, v in found_vbs_info.items()}
-    scores['f1_score_per_bundle'] = {k: v["f1_score"] for k, v in found_vbs_info.items()}
-
-    # Compute average bundle overlap, overreach and f1-score.
-    scores['mean_OL'] = np.mean(list(scores['overlap_per_bundle'].values()))
-    scores['mean_OR'] = np.mean(list(scores['overreach_per_bundle'].values()))
-    scores['mean_ORn'] = np.mean(list(scores['overreach_norm_gt_per_bundle'].values()))
-    scores['mean_F1'] = np.mean(list(scores['f1_score_per_bundle'].values()))
+    # Output writes are pushed to a small thread pool so the disk IO
+    # overlaps with the rest of the scoring; the inputs are not mutated
+    # after submission. Futures are drained before returning.
+    io_pool = ThreadPoolExecutor(max_workers=2)
+    io_futures = []
+
+    try:
+        if save_VBs or save_full_vc:
+            io_futures.append(io_pool.submit(
+                save_valid_connections, found_vbs_info, full_strl,
+                segmented_out_dir, segmented_base_name, ref_anat_fname,
+                save_vbs=save_VBs, save_full_vc=save_full_vc))
+
+        logging.debug("Starting IC, IB scoring")
+
+        total_strl_count = len(full_strl)
+
+        # Enumerate candidate ICs with a boolean mask instead of materializing
+        # two full Python sets of indices; flatnonzero gives them in order.
+        candidate_mask = np.ones(total_strl_count, dtype=bool)
+        if len(VC_indices):
+            vc_idx = np.fromiter(VC_indices, dtype=np.int64, count=len(VC_indices))
+            candidate_mask[vc_idx] = False
+        candidate_ic_strl_indices = np.flatnonzero(candidate_mask)
+
+        # Chosen from GT dataset
+        length_thres = 35.
+
+        # Filter streamlines that are too short, consider them as NC.
+        # Lengths were memoized on the sequence at load time; the threshold is
+        # applied to the candidate indices only.
+        lengths_mm = getattr(full_strl, 'lengths_mm', None)
+        if lengths_mm is None:
+            lengths_mm = streamlines_lengths_mm(full_strl)
+        long_enough = lengths_mm[candidate_ic_strl_indices] >= length_thres
+
+        # Gather the candidate subset with a single fancy-index pass over the
+        # sequence; the elements are float32 views into the shared buffer.
+        # Rejected streamlines are only tracked by index, and gathered below
+        # if they need to be saved.
+        candidate_ic_streamlines = list(full_strl[candidate_ic_strl_indices[long_enough]])
+        rejected_strl_indices = candidate_ic_strl_indices[~long_enough]
+
+        logging.debug('Found {} candidate IC'.format(len(candidate_ic_streamlines)))
+        logging.debug('Found {} streamlines that were too short'.format(rejected_strl_indices.size))
+
+        ic_counts = 0
+        nb_ib = 0
+        nb_rejected = rejected_strl_indices.size
+
+        additional_rejected_indices = np.zeros(0, dtype=np.int64)
+        if len(candidate_ic_streamlines):
+            additional_rejected_indices, ic_counts, nb_ib = group_and_assign_ibs(
+                                                       candidate_ic_streamlines,
+                                                       ROIs, save_IBs, save_full_ic,
+                                                       segmented_out_dir,
+                                                       segmented_base_name,
+                                                       ref_anat_fname)
+
+            nb_rejected += additional_rejected_indices.size
+
+        if ic_counts != candidate_ic_strl_indices.size - nb_rejected:
+            raise ValueError("Some streamlines were not correctly assigned to NC")
+
+        if nb_rejected > 0 and save_full_nc:
+            # The additional rejected indices point into candidate_ic_streamlines
+            # (which group_and_assign_ibs shuffled in place).
+            rejected_streamlines = list(full_strl[rejected_strl_indices])
+            rejected_streamlines.extend(candidate_ic_streamlines[idx]
+                                        for idx in additional_rejected_indices)
+
+            out_nc_fname = os.path.join(segmented_out_dir,
+                                        '{}_NC.tck'.format(segmented_base_name))
+            out_file = TCK.create(out_nc_fname)
+            io_futures.append(io_pool.submit(
+                save_tracts_tck_from_dipy_voxel_space, out_file, ref_anat_fname,
+                rejected_streamlines))
+
+        VC /= total_strl_count
+        IC = (candidate_ic_strl_indices.size - nb_rejected) / total_strl_count
+        NC = nb_rejected / total_strl_count
+        VCWP = 0
+
+        # Get the VB count, streamline count, bundle overlap, overreach and
+        # f1-score for each bundle, and accumulate the sums for the averages,
+        # all in a single pass over found_vbs_info.
+        overlap_per_bundle = {}
+        overreach_per_bundle = {}
+        overreach_norm_per_bundle = {}
+        f1_score_per_bundle = {}
+        streamlines_per_bundle = {}
+        nb_VB_found = 0
+        ol_sum = or_sum = orn_sum = f1_sum = 0.0
+
+        for k, v in found_vbs_info.items():
+            if v['nb_streamlines'] > 0:
+                nb_VB_found += 1
+                streamlines_per_bundle[k] = v['nb_streamlines']
+
+            overlap_per_bundle[k] = v["overlap"]
+            overreach_per_bundle[k] = v["overreach"]
+            overreach_norm_per_bundle[k] = v["overreach_norm"]
+            f1_score_per_bundle[k] = v["f1_score"]
+
+            ol_sum += v["overlap"]
+            or_sum += v["overreach"]
+            orn_sum += v["overreach_norm"]
+            f1_sum += v["f1_score"]
+
+        scores = {}
+        scores['version'] = 2
+        scores['algo_version'] = 6
+        scores['VC'] = VC
+        scores['IC'] = IC
+        scores['VCWP'] = VCWP
+        scores['NC'] = NC
+        scores['VB'] = nb_VB_found
+        scores['IB'] = nb_ib
+        scores['streamlines_per_bundle'] = streamlines_per_bundle
+        scores['total_streamlines_count'] = total_strl_count
+
+        scores['overlap_per_bundle'] = overlap_per_bundle
+        scores['overreach_per_bundle'] = overreach_per_bundle
+        scores['overreach_norm_gt_per_bundle'] = overreach_norm_per_bundle
+        scores['f1_score_per_bundle'] = f1_score_per_bundle
+
+        # Compute average bundle overlap, overreach and f1-score.
+        nb_bundles = len(found_vbs_info)
+        scores['mean_OL'] = ol_sum / nb_bundles
+        scores['mean_OR'] = or_sum / nb_bundles
+        scores['mean_ORn'] = orn_sum / nb_bundles
+        scores['mean_F1'] = f1_sum / nb_bundles
+
+    finally:
+        # Always wait for the pending writes, even when scoring raised,
+        # so the futures are not silently abandoned mid-write.
+        io_pool.shutdown(wait=True)
+
+    # Surface any exception raised by the asynchronous writes.
+    for io_future in io_futures:
+        io_future.result()
 
     return scores
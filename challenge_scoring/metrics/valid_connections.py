@@ -10,7 +10,7 @@ from dipy.segment.clustering import QuickBundles
 from dipy.segment.metric import AveragePointwiseEuclideanMetric
 from dipy.tracking.distances import bundles_distances_mdf
 from dipy.tracking.streamline import set_number_of_points
-from nibabel.streamlines import Tractogram
+from nibabel.streamlines import ArraySequence, Tractogram
 import numpy as np
 
 from challenge_scoring import NB_POINTS_RESAMPLE
@@ -20,15 +20,42 @@ from challenge_scoring.metrics.bundle_coverage import compute_bundle_coverage_sc
 def auto_extract(model_cluster_map, submission_cluster_map,
                  number_pts_per_str=NB_POINTS_RESAMPLE,
                  close_centroids_thr=20,
-                 clean_thr=7.):
+                 clean_thr=7.,
+                 model_centroid_trees=None):
 
     model_centroids = model_cluster_map.centroids
-
-    centroid_matrix = bundles_distances_mdf(model_centroids,
-                                            submission_cluster_map.centroids)
-
-    centroid_matrix[centroid_matrix > close_centroids_thr] = np.inf
-    mins = np.min(centroid_matrix, axis=0)
+    submission_centroids = submission_cluster_map.centroids
+    nb_sub_centroids = len(submission_centroids)
+
+    mins = np.full(nb_sub_centroids, np.inf)
+
+    if model_centroid_trees is not None:
+        # Prefilter submission centroids with the kd-trees built over the
+        # flattened model centroids (both orientations). An MDF of thr
+        # implies a flattened euclidean distance of at most
+        # thr * number_pts_per_str, so a ball query with that radius gives
+        # a superset of the MDF-close centroids; the exact MDF below then
+        # only runs on the survivors.
+        sub_flat = np.reshape(np.asarray(submission_centroids, dtype='f4'),
+                              (nb_sub_centroids, -1))
+        radius = close_centroids_thr * number_pts_per_str
+
+        close_mask = np.zeros(nb_sub_centroids, dtype=bool)
+        for tree in model_centroid_trees:
+            hits = tree.query_ball_point(sub_flat, r=radius)
+            close_mask |= np.fromiter((len(h) > 0 for h in hits),
+                                      dtype=bool, count=nb_sub_centroids)
+        candidate_centroids_idx = np.flatnonzero(close_mask)
+    else:
+        candidate_centroids_idx = np.arange(nb_sub_centroids)
+
+    if candidate_centroids_idx.size:
+        centroid_matrix = bundles_distances_mdf(
+            model_centroids,
+            [submission_centroids[i] for i in candidate_centroids_idx])
+
+        centroid_matrix[centroid_matrix > close_centroids_thr] = np.inf
+        mins[candidate_centroids_idx] = np.min(centroid_matrix, axis=0)
     close_clusters = [submission_cluster_map[i]
                       for i in np.where(mins != np.inf)[0]]
     close_indices_inter = [submission_cluster_map[i].indices
@@ -95,9 +122,15 @@ def auto_extract_VCs(streamlines, ref_bundles):
         # Already resample and run quickbundles on the submission chunk,
         # to avoid doing it at every call of auto_extract
         rstreamlines = set_number_of_points(strl_chunk, NB_POINTS_RESAMPLE)
+        if not isinstance(rstreamlines, ArraySequence):
+            # dipy < 0.13 returns a plain list here.
+            rstreamlines = ArraySequence(rstreamlines)
 
-        # qb.cluster had problem with f8
-        rstreamlines = [s.astype('f4') for s in rstreamlines]
+        # qb.cluster had problem with f8. Cast the single backing buffer
+        # instead of allocating one small float32 array per streamline.
+        if rstreamlines._data.dtype != np.float32:
+            rstreamlines._data = rstreamlines._data.astype(np.float32,
+                                                           copy=False)
 
         chunk_cluster_map = qb.cluster(rstreamlines)
         chunk_cluster_map.refdata = strl_chunk
@@ -105,10 +138,16 @@ def auto_extract_VCs(streamlines, ref_bundles):
         logging.debug("Starting VC identification through auto_extract")
 
         for bundle_idx, ref_bundle in enumerate(ref_bundles):
+            centroid_trees = None
+            if ref_bundle.get('centroid_tree') is not None:
+                centroid_trees = (ref_bundle['centroid_tree'],
+                                  ref_bundle['centroid_tree_flipped'])
+
             # The selected indices are from [0, len(strl_chunk)]
             selected_streamlines_indices = auto_extract(ref_bundle['cluster_map'],
                                                         chunk_cluster_map,
-                                                        clean_thr=ref_bundle['threshold'])
+                                                        clean_thr=ref_bundle['threshold'],
+                                                        model_centroid_trees=centroid_trees)
 
             # Remove duplicates, when streamlines are assigned to multiple VBs.
             selected_streamlines_indices = set(selected_streamlines_indices) - \
@@ -18,19 +18,19 @@ def get_attribs_for_file(attribs_filepath, filename):
 
 
 def save_attribs(attribs_filepath, attribs):
-    with open(attribs_filepath, 'wb') as attribs_file:
+    with open(attribs_filepath, 'w') as attribs_file:
         json.dump(attribs, attribs_file)
 
 
 def merge_attribs(orig_attribs, additional_attribs, overwrite=False):
-    for fname, attr in additional_attribs.iteritems():
+    for fname, attr in additional_attribs.items():
         orig_value = orig_attribs.get(fname, None)
 
         if orig_value is None:
             # Item was not in dictionary
             orig_attribs[fname] = attr
         else:
-            for new_attr, new_val in attr.iteritems():
+            for new_attr, new_val in attr.items():
                 orig_attrib_val = orig_value.get(new_attr, None)
 
                 # If we didn't find the attribute, or the attribute
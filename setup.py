@@ -51,7 +51,9 @@ ext_modules.append(Extension('challenge_scoring.tractanalysis.robust_streamlines
                                                    os.path.realpath(__file__)),
                                                'challenge_scoring/c_src')]))
 
-dependencies = ['dipy', 'nibabel']
+# scipy >= 1.3 guarantees picklable cKDTree instances, which the GT
+# preparation returns from pool workers and stores in the on-disk cache.
+dependencies = ['dipy', 'nibabel', 'scipy>=1.3']
 
 setup(name='ismrm_2015_tractography_challenge_scoring', version='1.0.1',
       description='Scoring system used for the ISMRM 2015 Tractography Challenge',
@@ -59,5 +61,9 @@ setup(name='ismrm_2015_tractography_challenge_scoring', version='1.0.1',
       ext_modules=ext_modules, author='The challenge team',
       author_email='jean-christophe.houde@usherbrooke.ca',
       scripts=glob('scripts/*.py'), install_requires=dependencies,
+      # numba is optional: when present, the streamline length kernel
+      # runs as a parallel compiled loop instead of vectorized numpy.
+      extras_require={'numba': ['numba']},
+      python_requires='>=3.6',
       cmdclass={'build_ext': deactivate_default_build_ext,
                 'build_all': build_inplace_all_ext})